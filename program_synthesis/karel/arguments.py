@@ -119,6 +119,9 @@ def get_arg_parser(title, mode):
         eval_group.add_argument('--infer-output')
         eval_group.add_argument('--infer-limit', type=int)
         eval_group.add_argument('--save-beam-outputs', action='store_true')
+        eval_group.add_argument(
+            '--quantize-inference', action='store_true', default=False,
+            help='Quantize the decoder embeddings and linear layers to int8 (CPU only).')
 
     else:
         raise ValueError(mode)
@@ -135,6 +138,9 @@ def get_arg_parser(title, mode):
     infer_group.add_argument('--karel-mutate-ref', action='store_true')
     infer_group.add_argument('--karel-mutate-n-dist')
     infer_group.add_argument('--karel-trace-inc-val', action='store_true')
+    infer_group.add_argument(
+        '--karel-compile-decode', action='store_true', default=False,
+        help='Compile the trace decoder step with torch.compile and replay it with CUDA graphs.')
 
     runtime_group = parser.add_argument_group('runtime')
     runtime_group.add_argument(
@@ -167,6 +173,8 @@ def backport_default_args(args):
         "karel_refine_dec": "default",
         "karel_io_enc": "lgrl",
         "karel_trace_inc_val": True,
+        "karel_compile_decode": False,
+        "quantize_inference": False,
     }
     for key, value in backport.items():
         if not hasattr(args, key):
@@ -7,6 +7,11 @@ import re
 import numpy as np
 from collections import Counter
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 #from .hero import Hero
 from program_synthesis.karel.dataset.utils import Tcolors
 from program_synthesis.karel.dataset.utils import get_rng
@@ -307,3 +312,137 @@ class KarelRuntime(object):
     turnLeft = turn_left
     pickMarker = pick_marker
     putMarker = put_marker
+
+
+# Batched equivalents of KarelRuntime's actions and conditions, operating on
+# batch x 15 x height x width arrays in the same layout as KarelRuntime.world.
+# Action ids follow karel_trace.action_to_id; ids below 2 (<s>, </s>) leave
+# the fields untouched.
+BATCHED_MOVE = 2
+BATCHED_TURN_LEFT = 3
+BATCHED_TURN_RIGHT = 4
+BATCHED_PUT_MARKER = 5
+BATCHED_PICK_MARKER = 6
+
+_DIRECTIONS = np.array(KarelRuntime.DIRECTIONS)
+
+
+def batched_hero(fields):
+    '''Return (directions, ys, xs) of the hero in each field.'''
+    flat = fields[:, :4].reshape(fields.shape[0], -1).argmax(axis=1)
+    return np.unravel_index(flat, (4, ) + fields.shape[2:])
+
+
+def _batched_is_clear(fields, idx, dirs, ys, xs):
+    dys, dxs = _DIRECTIONS[dirs % 4].T
+    return np.logical_not(fields[idx, 4:6, ys + dys, xs + dxs].any(axis=1))
+
+
+def batched_step(fields, action_ids):
+    '''Apply one action to each field in place.
+
+    Uses a compiled loop over the batch if numba is installed.
+
+    fields: batch x 15 x height x width numpy.ndarray
+    action_ids: batch numpy.ndarray
+    '''
+    if numba is not None:
+        _compiled_batched_step(fields, action_ids)
+    else:
+        _vectorized_batched_step(fields, action_ids)
+
+
+def _vectorized_batched_step(fields, action_ids):
+    # Only touch the fields whose action is not a no-op (<s>, </s>); near the
+    # end of a batch of sequences, most of them are.
+    idx, = np.nonzero((action_ids >= BATCHED_MOVE) &
+                      (action_ids <= BATCHED_PICK_MARKER))
+    if not len(idx):
+        return
+    action_ids = action_ids[idx]
+    dirs, ys, xs = batched_hero(fields[idx, :4])
+
+    # move, turnLeft, turnRight: rewrite the hero cell of every active field.
+    move = (action_ids == BATCHED_MOVE) & _batched_is_clear(
+        fields, idx, dirs, ys, xs)
+    dys, dxs = _DIRECTIONS[dirs].T
+    new_ys = ys + move * dys
+    new_xs = xs + move * dxs
+    new_dirs = (dirs - (action_ids == BATCHED_TURN_LEFT) +
+                (action_ids == BATCHED_TURN_RIGHT)) % 4
+    fields[idx, dirs, ys, xs] = 0
+    fields[idx, new_dirs, new_ys, new_xs] = 1
+
+    # putMarker, pickMarker: marker planes 6-14 one-hot encode 1-9 markers.
+    marker = ((action_ids == BATCHED_PUT_MARKER) |
+              (action_ids == BATCHED_PICK_MARKER))
+    if not marker.any():
+        return
+    idx, ys, xs, action_ids = idx[marker], ys[marker], xs[marker], action_ids[
+        marker]
+    markers = fields[idx, 6:15, ys, xs]
+    counts = np.where(markers.any(axis=1), markers.argmax(axis=1) + 1, 0)
+    counts = np.clip(counts + (action_ids == BATCHED_PUT_MARKER) -
+                     (action_ids == BATCHED_PICK_MARKER), 0, 9)
+    fields[idx, 6:15, ys, xs] = 0
+    nonzero = counts > 0
+    fields[idx[nonzero], counts[nonzero] + 5, ys[nonzero], xs[nonzero]] = 1
+
+
+def _compiled_batched_step(fields, action_ids):
+    for i in numba.prange(fields.shape[0]):
+        action_id = action_ids[i]
+        if action_id < BATCHED_MOVE or action_id > BATCHED_PICK_MARKER:
+            continue
+
+        hero_dir, y, x = 0, 0, 0
+        for d in range(4):
+            for yy in range(fields.shape[2]):
+                for xx in range(fields.shape[3]):
+                    if fields[i, d, yy, xx]:
+                        hero_dir, y, x = d, yy, xx
+
+        if action_id == BATCHED_MOVE:
+            next_y = y + _DIRECTIONS[hero_dir, 0]
+            next_x = x + _DIRECTIONS[hero_dir, 1]
+            if not (fields[i, 4, next_y, next_x] or
+                    fields[i, 5, next_y, next_x]):
+                fields[i, hero_dir, y, x] = False
+                fields[i, hero_dir, next_y, next_x] = True
+        elif action_id == BATCHED_TURN_LEFT:
+            fields[i, hero_dir, y, x] = False
+            fields[i, (hero_dir + 3) % 4, y, x] = True
+        elif action_id == BATCHED_TURN_RIGHT:
+            fields[i, hero_dir, y, x] = False
+            fields[i, (hero_dir + 1) % 4, y, x] = True
+        else:
+            count = 0
+            for k in range(9):
+                if fields[i, 6 + k, y, x]:
+                    count = k + 1
+            if action_id == BATCHED_PUT_MARKER:
+                new_count = min(count + 1, 9)
+            else:
+                new_count = max(count - 1, 0)
+            if count > 0:
+                fields[i, 5 + count, y, x] = False
+            if new_count > 0:
+                fields[i, 5 + new_count, y, x] = True
+
+
+if numba is not None:
+    _compiled_batched_step = numba.njit(
+        parallel=True, cache=True)(_compiled_batched_step)
+
+
+def batched_conds(fields):
+    '''Return a batch x 4 array of frontIsClear, leftIsClear, rightIsClear and
+    markersPresent for each field.'''
+    idx = np.arange(fields.shape[0])
+    dirs, ys, xs = batched_hero(fields)
+    return np.stack([
+        _batched_is_clear(fields, idx, dirs, ys, xs),
+        _batched_is_clear(fields, idx, dirs - 1, ys, xs),
+        _batched_is_clear(fields, idx, dirs + 1, ys, xs),
+        fields[idx, 6:15, ys, xs].any(axis=1)
+    ], axis=1).astype(np.int64)
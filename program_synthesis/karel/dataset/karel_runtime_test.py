@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+from program_synthesis.karel.dataset import karel_runtime
+
+ACTIONS = ('move', 'turnLeft', 'turnRight', 'putMarker', 'pickMarker')
+
+
+def random_field(rng):
+    height, width = rng.randint(2, 17, size=2)
+    field = np.zeros((15, 18, 18), dtype=bool)
+    world = field[:, :height + 2, :width + 2]
+    world[4] = rng.rand(height + 2, width + 2) < 0.2
+    karel_runtime.border_mask(world[5], True)
+    karel_runtime.border_mask(world[4], False)
+    y, x = rng.randint(1, height + 1), rng.randint(1, width + 1)
+    world[4, y, x] = False
+    world[rng.randint(4), y, x] = True
+    counts = rng.randint(10, size=(height + 2, width + 2))
+    counts[world[4]] = 0
+    karel_runtime.border_mask(counts, 0)
+    for count in range(1, 10):
+        world[5 + count][counts == count] = True
+    return field
+
+
+class BatchedStepTest(unittest.TestCase):
+    def testMatchesKarelRuntime(self):
+        self._testMatchesKarelRuntime(karel_runtime.batched_step)
+
+    def testVectorizedMatchesKarelRuntime(self):
+        self._testMatchesKarelRuntime(karel_runtime._vectorized_batched_step)
+
+    def _testMatchesKarelRuntime(self, batched_step):
+        rng = np.random.RandomState(1234)
+        kr = karel_runtime.KarelRuntime()
+        fields = np.stack([random_field(rng) for _ in range(64)])
+        expected = fields.copy()
+
+        for _ in range(50):
+            action_ids = rng.randint(7, size=len(fields))
+            conds = []
+            for field, action_id in zip(expected, action_ids):
+                kr.init_from_array(field)
+                if action_id >= 2:
+                    getattr(kr, ACTIONS[action_id - 2])()
+                conds.append([
+                    int(v) for v in (kr.frontIsClear(), kr.leftIsClear(),
+                                     kr.rightIsClear(), kr.markersPresent())
+                ])
+
+            batched_step(fields, action_ids)
+            np.testing.assert_array_equal(fields, expected)
+            np.testing.assert_array_equal(
+                karel_runtime.batched_conds(fields), conds)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,6 +17,7 @@ from program_synthesis.karel.models import prepare_spec
 from program_synthesis.karel.models.modules import karel
 from program_synthesis.karel.models.modules import karel_common
 from program_synthesis.karel.models.modules import karel_trace
+from program_synthesis.karel.models.modules import utils
 
 
 def _get_example_key(args, example):
@@ -72,17 +73,27 @@ class KarelTracer(object):
         self.conds.append(cond)
 
 
+def maybe_quantize_decoder(model, args):
+    # Only registered for evaluation, so training args lack the flag.
+    if not getattr(args, 'quantize_inference', False):
+        return
+    if args.cuda:
+        raise ValueError(
+            '--quantize-inference only runs on the CPU; pass --no-cuda')
+    utils.quantize_dynamic(model.decoder)
+
+
 class TracePredictionModel(karel_model.BaseKarelModel):
     def __init__(self, args):
         self.model = karel_trace.TracePrediction(args)
         self.kr = karel_runtime.KarelRuntime()
         self.tracer = KarelTracer(self.kr, keep_failures=False)
-        self.eval_kr = karel_runtime.KarelRuntime()
 
         self.all_infer = 0
         self.correct_infer = 0
 
         super(TracePredictionModel, self).__init__(args)
+        maybe_quantize_decoder(self.model, args)
 
     def compute_loss(self, batch):
         (input_grids, output_grids, trace_grids, conds, input_actions,
@@ -113,15 +124,8 @@ class TracePredictionModel(karel_model.BaseKarelModel):
 
         io_embed = self.model.encode(input_grids, output_grids)
 
-        # batch.input_grids is always on CPU, unlike input_grids
-        fields = batch.input_grids.data.numpy().astype(bool)
-        cached_state = np.empty(fields.shape[0], dtype=np.object)
-        for i, field in enumerate(fields):
-            self.kr.init_from_array(field)
-            cached_state[i] = self.kr.cached_state()
-
         init_state = karel_trace.TraceDecoderState(
-            fields, cached_state,
+            input_grids.data.byte(),
             *self.model.decoder.init_state(input_grids.shape[0]))
         memory = karel.LGRLMemory(io_embed)
 
@@ -244,21 +248,27 @@ class TracePredictionModel(karel_model.BaseKarelModel):
 
     def eval(self, batch):
         results = self.inference(batch)
-        correct = 0
 
         input_grids = batch.input_grids.data.numpy().astype(bool)
         output_grids = batch.output_grids.data.numpy().astype(bool)
 
-        for i, (ex, result) in enumerate(zip(batch, results)):
-            action_seq = result.code_sequence
-            self.eval_kr.init_from_array(input_grids[i])
-            for action in action_seq:
-                getattr(self.eval_kr, action)()
-            # input_grids[i] is mutated in place by self.eval_kr.
-            is_correct = np.all(input_grids[i] == output_grids[i])
-            correct += 1 if is_correct else 0
+        # Replay all predicted action sequences together, one time step at a
+        # time. Shorter sequences are padded with </s>, which is a no-op.
+        max_length = max([0] + [len(r.code_sequence) for r in results])
+        action_ids = np.full((len(results), max_length),
+                             karel_trace.action_to_id['</s>'])
+        for i, result in enumerate(results):
+            action_ids[i, :len(result.code_sequence)] = [
+                karel_trace.action_to_id[action]
+                for action in result.code_sequence
+            ]
+        for step_action_ids in action_ids.T:
+            # input_grids is mutated in place.
+            karel_runtime.batched_step(input_grids, step_action_ids)
 
-        return {'correct': correct, 'total': len(results)}
+        is_correct = np.all(
+            (input_grids == output_grids).reshape(len(results), -1), axis=1)
+        return {'correct': int(is_correct.sum()), 'total': len(results)}
 
     def batch_processor(self, for_eval):
         return TracePredictionBatchProcessor(self.args, for_eval)
@@ -319,9 +329,11 @@ class TracePredictionBatchProcessor(object):
         input_grids, output_grids = [
             Variable(t, volatile=self.for_eval) for t in (input_grids, output_grids)
         ]
+        # Kept as bytes until on the model's device, where TraceDecoder
+        # converts them to float.
         trace_grids = karel_model.lists_to_packed_sequence(
-            trace_grids, (15, 18, 18), torch.FloatTensor,
-            lambda item, batch_idx, out: out.copy_(torch.from_numpy(item.astype(np.float32))),
+            trace_grids, (15, 18, 18), torch.ByteTensor,
+            lambda item, batch_idx, out: out.copy_(torch.from_numpy(item.astype(np.uint8))),
             volatile=self.for_eval)
         conds = karel_model.lists_to_packed_sequence(
             conds, (4,), torch.LongTensor,
@@ -363,6 +375,7 @@ class CodeFromTracesModel(karel_model.BaseKarelModel):
         self.trace_event_lengths  = []
         self.trace_lengths = []
         super(CodeFromTracesModel, self).__init__(args)
+        maybe_quantize_decoder(self.model, args)
 
     def compute_loss(self, batch):
         if self.args.cuda:
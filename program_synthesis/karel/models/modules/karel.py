@@ -159,9 +159,11 @@ class LGRLSeqDecoder(nn.Module):
                                                       -1)
         # batch size (* beam size) x num pairs x hidden size
         decoder_input = torch.cat([token_embed, io_embed], dim=2)
-        decoder_output, new_state = self.decoder(
-            # batch size (* beam size) * num pairs x 1 x hidden size
-            decoder_input.view(-1, decoder_input.shape[-1]).unsqueeze(1),
+        # decoder_output: batch size (* beam size) * num pairs x hidden
+        decoder_output, new_state = utils.lstm_step(
+            self.decoder,
+            # batch size (* beam size) * num pairs x hidden size
+            decoder_input.view(-1, decoder_input.shape[-1]),
             # v before: 2 x batch size (* beam size) x num pairs x hidden
             # v after:  2 x batch size (* beam size) * num pairs x hidden
             tuple(v.view(v.shape[0], -1, v.shape[-1]) for v in state))
@@ -169,8 +171,6 @@ class LGRLSeqDecoder(nn.Module):
                                               pairs_per_example, v.shape[-1])
                                        for v in new_state))
 
-        # shape after squeezing: batch size (* beam size) * num pairs x hidden
-        decoder_output = decoder_output.squeeze(1)
         decoder_output = decoder_output.view(-1, pairs_per_example,
                                              *decoder_output.shape[1:])
         decoder_output, _ = decoder_output.max(dim=1)
@@ -667,18 +667,18 @@ class LGRLSeqRefineDecoder(nn.Module):
                 if self.has_memory else None], dim=2)
         decoder_input = decoder_input.view(-1, decoder_input.shape[-1])
 
-        # decoder_output: 1 x batch (* beam) * num pairs x hidden size
+        # decoder_output: batch (* beam) * num pairs x hidden size
         # new_state: length-2 tuple of
         #   2 x batch (* beam) * num pairs x hidden size
-        decoder_output, new_state = self.decoder(
-            # 1 x batch (* beam) * num pairs x hidden size
-            decoder_input.unsqueeze(0),
+        decoder_output, new_state = utils.lstm_step(
+            self.decoder,
+            # batch (* beam) * num pairs x hidden size
+            decoder_input,
             # v before: 2 x batch (* beam) x num pairs x hidden
             # v after:  2 x batch (* beam) * num pairs x hidden
             (utils.flatten(state.h, 1), utils.flatten(state.c, 1)))
         new_state = (new_state[0].view_as(state.h),
                      new_state[1].view_as(state.c))
-        decoder_output = decoder_output.squeeze(0)
 
         code_context, trace_context = None, None
         if memory.code:
@@ -1062,17 +1062,16 @@ class LGRLSeqRefineEditDecoder(nn.Module):
         dec_input = utils.maybe_concat([op_emb, code_memory, last_token_emb,
             utils.flatten(memory.io, 0)], dim=1)
 
-        dec_output, new_state = self.decoder(
-                # 1 (time) x batch (* beam) * num pairs x hidden size
-                dec_input.unsqueeze(0),
+        # dec_output: batch size (* beam size) * num pairs x hidden
+        dec_output, new_state = utils.lstm_step(
+                self.decoder,
+                # batch (* beam) * num pairs x hidden size
+                dec_input,
                 # v before: 2 x batch (* beam) x num pairs x hidden
                 # v after:  2 x batch (* beam) * num pairs x hidden
                 (utils.flatten(state.h, 1), utils.flatten(state.c, 1)))
         new_state = (new_state[0].view_as(state.h),
                                  new_state[1].view_as(state.c))
-
-        # shape after squeezing: batch size (* beam size) * num pairs x hidden
-        dec_output = dec_output.squeeze(0)
         if self.use_code_attn:
             new_context, _ = self.code_attention(
                 dec_output,
@@ -304,7 +304,10 @@ class KarelEdit(nn.Module):
         return log_probs[range(log_probs.shape[0]), idx]
 
     def tf_batched_sum(self, v1, v2, v3, v4, v5):
-        return torch.sum(torch.stack((v1, v2, v3, v4, v5), dim=-1), dim=-1)
+        result = v1 + v2
+        for v in (v3, v4, v5):
+            result.add_(v)
+        return result
 
 
 # Example:
@@ -0,0 +1,40 @@
+import argparse
+import unittest
+
+import torch
+
+from program_synthesis.karel.models.modules import karel_edit
+
+
+class TFBatchedSumTest(unittest.TestCase):
+    def testMatchesStackedSum(self):
+        torch.manual_seed(1234)
+        args = argparse.Namespace(
+            cuda=False,
+            num_placeholders=0,
+            karel_io_enc='lgrl',
+            karel_io_conv_blocks=2,
+            karel_trace_grid_enc='presnet',
+            karel_code_enc='default',
+            karel_merge_io='max')
+        model = karel_edit.KarelEdit(30, args)
+
+        inputs = [torch.randn(6, 256, requires_grad=True) for _ in range(5)]
+        orig_inputs = [v.detach().clone() for v in inputs]
+        weight = torch.randn(6, 256)
+        result = model.tf_batched_sum(*inputs)
+        grads = torch.autograd.grad((result * weight).sum(), inputs)
+
+        expected = torch.sum(torch.stack(inputs, dim=-1), dim=-1)
+        expected_grads = torch.autograd.grad((expected * weight).sum(), inputs)
+
+        self.assertTrue(torch.allclose(result, expected, atol=1e-6))
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertTrue(torch.equal(grad, expected_grad))
+        # The in-place additions must not write through to the operands.
+        for v, orig_v in zip(inputs, orig_inputs):
+            self.assertTrue(torch.equal(v, orig_v))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,13 @@
 import collections
 
-import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Variable
 
 from program_synthesis.common.modules import attention
 from program_synthesis.common.models import beam_search
 
-from program_synthesis.karel.dataset import karel_runtime
 from program_synthesis.karel.models import base
 from program_synthesis.karel.models import prepare_spec
 from program_synthesis.karel.models.modules import karel_common
@@ -34,8 +33,68 @@ id_to_action = {
 }
 
 
+def _hero(fields):
+    # Returns directions, ys, xs of the hero in each field.
+    height, width = fields.shape[2:]
+    flat = fields[:, :4].contiguous().view(fields.shape[0], -1).argmax(dim=1)
+    return flat // (height * width), flat // width % height, flat % width
+
+
+def _is_clear(fields, idx, dirs, ys, xs):
+    dirs = dirs % 4
+    ys = ys + (dirs == 0).long() - (dirs == 2).long()
+    xs = xs + (dirs == 1).long() - (dirs == 3).long()
+    return (fields[idx, 4, ys, xs] == 0) & (fields[idx, 5, ys, xs] == 0)
+
+
+def karel_step(fields, actions):
+    '''Torch equivalent of karel_runtime.batched_step, on fields of any
+    device. Updates fields in place.
+
+    fields: batch x 15 x 18 x 18 ByteTensor
+    actions: batch LongTensor, with ids from action_to_id
+    '''
+    idx = torch.arange(fields.shape[0], device=fields.device)
+    dirs, ys, xs = _hero(fields)
+
+    # move, turnLeft, turnRight
+    move = (actions == action_to_id['move']) & _is_clear(
+        fields, idx, dirs, ys, xs)
+    new_ys = ys + (move & (dirs == 0)).long() - (move & (dirs == 2)).long()
+    new_xs = xs + (move & (dirs == 1)).long() - (move & (dirs == 3)).long()
+    new_dirs = (dirs - (actions == action_to_id['turnLeft']).long() +
+                (actions == action_to_id['turnRight']).long()) % 4
+    fields[idx, dirs, ys, xs] = 0
+    fields[idx, new_dirs, new_ys, new_xs] = 1
+
+    # putMarker, pickMarker
+    # cells: batch x 15, the planes at the hero's position
+    cells = fields.permute(0, 2, 3, 1)
+    counts = torch.arange(1, 10, device=fields.device)
+    num_markers = (cells[idx, new_ys, new_xs, 6:].long() *
+                   counts.unsqueeze(0)).sum(dim=1)
+    num_markers = (num_markers +
+                   (actions == action_to_id['putMarker']).long() -
+                   (actions == action_to_id['pickMarker']).long()).clamp(0, 9)
+    cells[idx, new_ys, new_xs, 6:] = (
+        num_markers.unsqueeze(1) == counts.unsqueeze(0)).type_as(fields)
+
+
+def karel_conds(fields):
+    '''Torch equivalent of karel_runtime.batched_conds.'''
+    dirs, ys, xs = _hero(fields)
+    idx = torch.arange(fields.shape[0], device=fields.device)
+    markers = fields.permute(0, 2, 3, 1)[idx, ys, xs, 6:]
+    return torch.stack([
+        _is_clear(fields, idx, dirs, ys, xs),
+        _is_clear(fields, idx, dirs - 1, ys, xs),
+        _is_clear(fields, idx, dirs + 1, ys, xs),
+        (markers != 0).sum(dim=1) > 0
+    ], dim=1).long()
+
+
 class TraceDecoderState(
-        collections.namedtuple('TraceDecoderState', ['field', 'cached_state', 'h', 'c']),
+        collections.namedtuple('TraceDecoderState', ['field', 'h', 'c']),
         beam_search.BeamSearchState):
     def select_for_beams(self, batch_size, indices):
         '''Return the hidden state necessary to continue the beams.
@@ -43,20 +102,14 @@ class TraceDecoderState(
         batch size: int
         indices: 2 x batch size * beam size LongTensor
         '''
-        # field: batch size (* beam size) x 15 x 18 x 18, numpy.ndarray
-        indices_tuple = tuple(indices.data.numpy())
-        selected = [
-            self.field.reshape(
-                batch_size, -1,
-                *self.field.shape[1:])[indices_tuple],
-            self.cached_state.reshape(batch_size, -1)[indices_tuple]
-        ]
+        flat_indices = utils.beam_indices_to_flat(
+            indices, batch_size, self.h.shape[1], self.h.device)
+        # field: batch size (* beam size) x 15 x 18 x 18, ByteTensor
+        selected = [self.field.index_select(0, flat_indices)]
         for v in self.h, self.c:
             # before: 2 x batch size (* beam size) x num pairs x hidden
-            # after:  2 x batch size x beam size x num pairs x hidden
-            v = v.view(2, batch_size, -1, *v.shape[2:])
             # result: 2 x indices.shape[1] x num pairs x hidden
-            selected.append(v[(slice(None), ) + indices_tuple])
+            selected.append(v.index_select(1, flat_indices))
         return TraceDecoderState(*selected)
 
 
@@ -95,10 +148,19 @@ class TraceDecoder(nn.Module):
         self.action_embed = nn.Embedding(num_actions, 256)
         self.out = nn.Linear(256, num_actions)
 
+        # The batch size (number of beams) varies from batch to batch, so one
+        # dynamic graph covers all of them; CUDA graphs are recorded once per
+        # batch size and replayed on every later step with that size.
+        self._compiled_decode_step = None
+        if args.karel_compile_decode and hasattr(torch, 'compile'):
+            self._compiled_decode_step = torch.compile(
+                self._functional_decode_step, mode='reduce-overhead',
+                dynamic=True)
+
     def forward(self, io_embed, trace_grids, conds, input_actions,
                 output_actions, io_embed_indices):
         # io_embed: batch size x 512
-        # trace_grids: PackedSequencePlus
+        # trace_grids: PackedSequencePlus, ByteTensor
         #   batch size x trace length x 15 x 18 x 18
         # conds: PackedSequencePlus
         #   batch size x trace length x 4
@@ -112,13 +174,17 @@ class TraceDecoder(nn.Module):
         input_actions = input_actions.apply(self.action_embed)
 
         # 256 or none
-        trace_grids = trace_grids.apply(self.grid_encoder)
+        trace_grids = trace_grids.apply(
+            lambda grids: self.grid_encoder(grids.float()))
         # 256 or none
         conds = conds.apply(self.cond_embed)
 
+        # len(input_actions) x 512
+        io_embed = io_embed.index_select(0, io_embed_indices)
+
         dec_input = input_actions.apply(
             lambda d: utils.maybe_concat((d, trace_grids.ps.data, conds.ps.data,
-                io_embed[io_embed_indices]), dim=1))
+                io_embed), dim=1))
 
         dec_output, state = self.decoder(dec_input.ps)
 
@@ -126,35 +192,31 @@ class TraceDecoder(nn.Module):
         return logits, output_actions.ps.data
 
     def decode_token(self, token, state, memory, attentions=None):
-        io_embed = memory.value
-
+        step = self._decode_step
+        if self._compiled_decode_step is not None and token.is_cuda:
+            step = self._compiled_decode_step
+        fields, h, c, logits = step(
+            token, state.field, state.h, state.c, memory.value,
+            utils.lstm_weights(self.decoder))
+        return TraceDecoderState(fields, h, c), logits
+
+    def _functional_decode_step(self, token, fields, h, c, io_embed,
+                                lstm_weights):
+        # CUDA graphs are not recorded for steps that mutate their inputs, so
+        # advance a copy of the grids instead.
+        return self._decode_step(
+            token, fields.clone(), h, c, io_embed, lstm_weights)
+
+    def _decode_step(self, token, fields, h, c, io_embed, lstm_weights):
         # Advance the grids with the last action
         if (self.grid_encoder is not karel_common.none_fn
                 or self.cond_embed is not karel_common.none_fn):
-            kr = karel_runtime.KarelRuntime()
-            fields = state.field.copy()
-            cached_states = np.empty_like(state.cached_state)
-            conds = []
-            for i, (field, cached_state, action_id) in enumerate(zip(
-                    fields, state.cached_state, token.data.cpu())):
-                kr.init_from_array(field, cached_state)
-                if action_id >= 2:  # Ignore <s>, </s>
-                    getattr(kr, id_to_action[action_id])()
-                conds.append([
-                    int(v) for v in (kr.frontIsClear(), kr.leftIsClear(),
-                                     kr.rightIsClear(), kr.markersPresent())
-                ])
-                cached_states[i] = kr.cached_state()
-            fields_t = Variable(torch.from_numpy(fields.astype(np.float32)))
-            conds_t = Variable(torch.LongTensor(conds))
-            if self._cuda:
-                fields_t = fields_t.cuda()
-                conds_t = conds_t.cuda()
-            grid_embed = self.grid_encoder(fields_t)
-            cond_embed = self.cond_embed(conds_t)
+            # The previous grids are not needed once advanced, and
+            # select_for_beams always gathers into a new tensor, so it is
+            # safe to update them in place.
+            karel_step(fields, token)
+            grid_embed, cond_embed = self.encode_fields(fields)
         else:
-            fields = state.field
-            cached_state = state.cached_state
             grid_embed = None
             cond_embed = None
 
@@ -164,16 +226,26 @@ class TraceDecoder(nn.Module):
         # batch size (* beam size) x (256 + 256 + 512)
         dec_input = utils.maybe_concat(
             (action_embed, grid_embed, cond_embed, io_embed), dim=1)
-        dec_output, new_state = self.decoder(
-            # 1 x batch size (* beam size) x hidden size
-            dec_input.unsqueeze(0),
-            (state.h, state.c))
-
-        # Shape after squeezing: batch size (* beam size) x 256
-        dec_output = dec_output.squeeze(0)
+        # dec_output: batch size (* beam size) x 256
+        dec_output, (h, c) = utils.lstm_step_with_weights(
+            lstm_weights, dec_input, (h, c))
         logits = self.out(dec_output)
 
-        return TraceDecoderState(fields, cached_states, *new_state), logits
+        return fields, h, c, logits
+
+    def encode_fields(self, fields):
+        '''Embed the grids and conditionals of all beams in one batch.
+
+        The whole grid is re-encoded after every action: the grid encoders
+        end in a linear layer over the full feature map, whose inputs depend
+        on nearly every cell, so there is no cheaper local update.
+
+        fields: batch size (* beam size) x 15 x 18 x 18 ByteTensor
+        Returns grid_embed and cond_embed, each
+        batch size (* beam size) x 256 or None.
+        '''
+        return (self.grid_encoder(fields.float()),
+                self.cond_embed(karel_conds(fields)))
 
     def init_state(self, *args):
         return utils.lstm_init(self._cuda, 2, 256, *args)
@@ -201,8 +273,20 @@ class MultiEmbedding(nn.Module):
     def __init__(self, sizes, dims, combiner='sum'):
         super(MultiEmbedding, self).__init__()
 
+        dims = set(int(dim) for dim in dims)
+        assert len(dims) == 1
+        dim, = dims
         self.embeddings = nn.ModuleList(
-            [nn.Embedding(size, int(dim)) for size, dim in zip(sizes, dims)])
+            [nn.Embedding(size, dim) for size in sizes])
+        for embedding in self.embeddings:
+            # forward reads the weights directly, so keep them unquantized.
+            embedding.qconfig = None
+        # All columns are looked up in the concatenation of the tables; input
+        # column i is offset by the sizes of the tables before it.
+        offsets = [sum(sizes[:i]) for i in range(len(sizes))]
+        self.register_buffer(
+            'offsets', torch.LongTensor(offsets), persistent=False)
+
         if combiner == 'sum':
             self.combiner = self._sum
         elif combiner == 'cat':
@@ -211,16 +295,20 @@ class MultiEmbedding(nn.Module):
             raise ValueError(combiner)
 
     def forward(self, inputs):
-        return self.combiner([
-            embedding(inputs[:, i])
-            for i, embedding in enumerate(self.embeddings)
-        ])
+        # inputs: batch x number of embeddings
+        # Merging the tables costs an extra kernel and a small allocation per
+        # call (they have sum(sizes) rows, 8 for the conditionals). It is not
+        # cached, so that it follows the weights in training and traces
+        # cleanly under torch.compile.
+        weight = torch.cat(
+            [embedding.weight for embedding in self.embeddings], dim=0)
+        return self.combiner(inputs + self.offsets.unsqueeze(0), weight)
 
-    def _sum(self, values):
-        return torch.sum(torch.stack(values), dim=0)
+    def _sum(self, indices, weight):
+        return F.embedding_bag(indices, weight, mode='sum')
 
-    def _cat(self, values):
-        return torch.cat(values, dim=1)
+    def _cat(self, indices, weight):
+        return F.embedding(indices, weight).view(indices.shape[0], -1)
 
 
 class IndividualTraceEncoder(nn.Module):
@@ -327,8 +415,40 @@ class LatePoolingCodeDecoder(nn.Module):
                 beam_size)
             return LatePoolingCodeDecoder.Memory(io_exp, trace_exp)
 
-    # TODO: Deduplicate with LGRLRefineDecoderState.
-    State = utils.MultiContextLSTMState
+    class State(
+            collections.namedtuple(
+                'State', ('context', 'h', 'c', 'pairs_per_example')),
+            beam_search.BeamSearchState):
+        # context: batch (* beam) x num pairs x hidden size, or None
+        # h, c: 2 x batch (* beam) * num pairs x hidden size, laid out as
+        #   the LSTM consumes them so that no reshapes are needed per step.
+        def select_for_beams(self, batch_size, indices):
+            '''Return the hidden state necessary to continue the beams.
+
+            batch size: int
+            indices: 2 x batch size * beam size LongTensor
+            '''
+            pairs_per_example = self.pairs_per_example
+            flat_indices = utils.beam_indices_to_flat(
+                indices, batch_size, self.h.shape[1] // pairs_per_example,
+                self.h.device)
+            context = None if self.context is None else (
+                self.context.index_select(0, flat_indices))
+            # Rows of h and c for every pair of the selected beams
+            pair_indices = (
+                flat_indices.unsqueeze(1) * pairs_per_example +
+                torch.arange(0, pairs_per_example,
+                             out=flat_indices.new()).unsqueeze(0)).view(-1)
+            return LatePoolingCodeDecoder.State(
+                context, self.h.index_select(1, pair_indices),
+                self.c.index_select(1, pair_indices), pairs_per_example)
+
+        def truncate(self, k):
+            k_pairs = k * self.pairs_per_example
+            return LatePoolingCodeDecoder.State(
+                None if self.context is None else self.context[:k],
+                self.h[:, :k_pairs], self.c[:, :k_pairs],
+                self.pairs_per_example)
 
     def __init__(self, vocab_size, args):
         super(LatePoolingCodeDecoder, self).__init__()
@@ -403,7 +523,9 @@ class LatePoolingCodeDecoder(nn.Module):
         memory = LatePoolingCodeDecoder.Memory(io_embed_slice,
                 trace_memory_slice)
 
-        logits = []
+        # total length of all sequences x vocab size
+        logits = input_code.ps.data.new(input_code.ps.data.shape[0],
+                                        self.out.out_features)
         offset = 0
         last_bs = 0
         batch_order = input_code.orig_to_sort
@@ -426,16 +548,15 @@ class LatePoolingCodeDecoder(nn.Module):
 
             state, logits_for_t = self.compute_next_token_logits(
                 state, memory, dec_data_slice)
-            logits.append(logits_for_t)
+            logits[offset:offset + bs] = logits_for_t
             offset += bs
             last_bs = bs
 
-        logits = torch.cat(logits, dim=0)
         labels = output_code.ps.data
         return logits, labels
 
     def decode_token(self, token, state, memory, attentions):
-        pairs_per_example = state.context.shape[1]
+        pairs_per_example = state.pairs_per_example
 
         # token: LongTensor, batch (* beam)
         token_emb = self.code_embed(token)
@@ -448,29 +569,22 @@ class LatePoolingCodeDecoder(nn.Module):
     def compute_next_token_logits(self, state, memory, last_token_emb):
         # state:
         #   context: batch (* beam) x num pairs x hidden size
-        #   h: 2 x batch (* beam) x num pairs x hidden size
-        #   c: 2 x batch (* beam) x num pairs x hidden size
+        #   h: 2 x batch (* beam) * num pairs x hidden size
+        #   c: 2 x batch (* beam) * num pairs x hidden size
         # memory:
         #   io: batch (* beam) x num pairs x hidden size
         #   trace: batch (* beam) x num pairs x trace length x hidden size
         # last_token_emb: batch (* beam) x num pairs x hidden size
-        pairs_per_example = state.h.shape[2]
+        pairs_per_example = state.pairs_per_example
 
         dec_input = utils.maybe_concat(
             (last_token_emb, memory.io, state.context), dim=2)
         # batch (* beam) * num pairs x hidden size
         dec_input = dec_input.view(-1, dec_input.shape[-1])
 
-        dec_output, new_state = self.decoder(
-            # 1 x batch (* beam) * num pairs x hidden size
-            dec_input.unsqueeze(0),
-            # v before: 2 x batch (* beam) x num pairs x hidden
-            # v after:  2 x batch (* beam) * num pairs x hidden
-            (utils.flatten(state.h, 1),
-             utils.flatten(state.c, 1)))
-        new_state = (new_state[0].view_as(state.h),
-                     new_state[1].view_as(state.c))
-        dec_output = dec_output.squeeze(0)
+        # dec_output: batch (* beam) * num pairs x hidden size
+        dec_output, new_state = utils.lstm_step(
+            self.decoder, dec_input, (state.h, state.c))
 
         new_context = None
         if memory.trace:
@@ -491,7 +605,7 @@ class LatePoolingCodeDecoder(nn.Module):
         return LatePoolingCodeDecoder.State(
             None if new_context is None else
             new_context.view(-1, pairs_per_example, new_context.shape[-1]),
-            *new_state), logits
+            new_state[0], new_state[1], pairs_per_example), logits
 
     def init_state(self, batch_size, pairs_per_example):
         if self.use_trace_memory:
@@ -502,9 +616,9 @@ class LatePoolingCodeDecoder(nn.Module):
         else:
             context = None
 
-        return LatePoolingCodeDecoder.State(
-            context, *utils.lstm_init(
-                self._cuda, 2, 256, batch_size, pairs_per_example))
+        h, c = utils.lstm_init(
+            self._cuda, 2, 256, batch_size * pairs_per_example)
+        return LatePoolingCodeDecoder.State(context, h, c, pairs_per_example)
 
 
 class CodeFromTraces(nn.Module):
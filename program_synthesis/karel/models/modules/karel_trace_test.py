@@ -0,0 +1,210 @@
+import argparse
+import copy
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from program_synthesis.common.tools import saver
+from program_synthesis.karel.dataset import karel_runtime
+from program_synthesis.karel.dataset.karel_runtime_test import random_field
+from program_synthesis.karel.models.modules import karel_trace
+from program_synthesis.karel.models.modules import utils
+
+
+class KarelStepTest(unittest.TestCase):
+    def testMatchesBatchedStep(self):
+        rng = np.random.RandomState(1234)
+        fields = np.stack([random_field(rng) for _ in range(64)])
+        fields_t = torch.from_numpy(fields.astype(np.uint8))
+
+        for _ in range(50):
+            action_ids = rng.randint(7, size=len(fields))
+            karel_runtime.batched_step(fields, action_ids)
+            karel_trace.karel_step(fields_t, torch.from_numpy(action_ids))
+
+            np.testing.assert_array_equal(fields_t.numpy(), fields)
+            np.testing.assert_array_equal(
+                karel_trace.karel_conds(fields_t).numpy(),
+                karel_runtime.batched_conds(fields))
+
+
+@unittest.skipUnless(hasattr(torch, 'compile'), 'requires torch.compile')
+class CompiledDecodeStepTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1234)
+        self.rng = np.random.RandomState(1234)
+        torch._dynamo.reset()
+
+    def make_inputs(self, decoder, batch_size, cuda=False):
+        fields = torch.from_numpy(
+            np.stack([random_field(self.rng) for _ in range(batch_size)])
+            .astype(np.uint8))
+        token = torch.from_numpy(self.rng.randint(7, size=batch_size))
+        io_embed = torch.randn(batch_size, 512)
+        if cuda:
+            fields = fields.cuda()
+            token = token.cuda()
+            io_embed = io_embed.cuda()
+        h, c = decoder.init_state(batch_size)
+        return (token, fields, h, c, io_embed,
+                utils.lstm_weights(decoder.decoder))
+
+    def make_decoder(self, cuda=False):
+        args = argparse.Namespace(
+            cuda=cuda,
+            karel_trace_grid_enc='presnet',
+            karel_trace_cond_enc='concat',
+            karel_compile_decode=True)
+        decoder = karel_trace.TraceDecoder(args).eval()
+        return decoder.cuda() if cuda else decoder
+
+    def testNoGraphBreaks(self):
+        decoder = self.make_decoder()
+        with torch.no_grad():
+            explanation = torch._dynamo.explain(
+                decoder._functional_decode_step)(
+                    *self.make_inputs(decoder, 4))
+        self.assertEqual(explanation.graph_break_count, 0)
+
+    def testOneGraphForAllBatchSizes(self):
+        decoder = self.make_decoder()
+        counters = torch._dynamo.utils.counters
+        counters.clear()
+        with torch.no_grad():
+            for batch_size in (4, 6, 9):
+                inputs = self.make_inputs(decoder, batch_size)
+                orig_fields = inputs[1].clone()
+                compiled = decoder._compiled_decode_step(*inputs)
+                self.assertTrue(torch.equal(inputs[1], orig_fields))
+                expected = decoder._decode_step(
+                    inputs[0], orig_fields, *inputs[2:])
+                self.assertTrue(torch.equal(compiled[0], expected[0]))
+                for v, expected_v in zip(compiled[1:], expected[1:]):
+                    self.assertTrue(torch.allclose(v, expected_v, atol=1e-4))
+        self.assertEqual(counters['stats']['unique_graphs'], 1)
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'requires CUDA')
+    def testMatchesEagerOnCuda(self):
+        decoder = self.make_decoder(cuda=True)
+        token, fields, h, c, io_embed, lstm_weights = self.make_inputs(
+            decoder, 8, cuda=True)
+
+        with torch.no_grad():
+            for _ in range(10):
+                orig_fields = fields.clone()
+                compiled = decoder._compiled_decode_step(
+                    token, fields, h, c, io_embed, lstm_weights)
+                compiled = [v.clone() for v in compiled]
+                self.assertTrue(torch.equal(fields, orig_fields))
+                expected = decoder._decode_step(
+                    token, fields.clone(), h, c, io_embed, lstm_weights)
+
+                self.assertTrue(torch.equal(compiled[0], expected[0]))
+                for v, expected_v in zip(compiled[1:], expected[1:]):
+                    self.assertTrue(torch.allclose(v, expected_v, atol=1e-4))
+                fields, h, c, _ = expected
+                token = torch.from_numpy(self.rng.randint(7, size=8)).cuda()
+
+
+class QuantizedDecodeStepTest(unittest.TestCase):
+    def testMatchesFloat(self):
+        torch.manual_seed(1234)
+        rng = np.random.RandomState(1234)
+        args = argparse.Namespace(
+            cuda=False,
+            karel_trace_grid_enc='presnet',
+            karel_trace_cond_enc='sum',
+            karel_compile_decode=False)
+        decoder = karel_trace.TraceDecoder(args).eval()
+        quantized = utils.quantize_dynamic(copy.deepcopy(decoder))
+        self.assertIsNot(type(quantized.out), torch.nn.Linear)
+        self.assertIsNot(type(quantized.action_embed), torch.nn.Embedding)
+
+        multi_embeddings = [
+            m for m in quantized.modules()
+            if isinstance(m, karel_trace.MultiEmbedding)
+        ]
+        self.assertTrue(multi_embeddings)
+        for multi_embedding in multi_embeddings:
+            for embedding in multi_embedding.embeddings:
+                self.assertIs(type(embedding), torch.nn.Embedding)
+
+        batch_size = 4
+        fields = torch.from_numpy(
+            np.stack([random_field(rng) for _ in range(batch_size)])
+            .astype(np.uint8))
+        token = torch.from_numpy(rng.randint(7, size=batch_size))
+        io_embed = torch.randn(batch_size, 512)
+        h, c = decoder.init_state(batch_size)
+        with torch.no_grad():
+            expected = decoder._decode_step(
+                token, fields.clone(), h, c, io_embed,
+                utils.lstm_weights(decoder.decoder))
+            actual = quantized._decode_step(
+                token, fields.clone(), h, c, io_embed,
+                utils.lstm_weights(quantized.decoder))
+
+        self.assertTrue(torch.equal(actual[0], expected[0]))
+        for v, expected_v in zip(actual[1:], expected[1:]):
+            self.assertTrue(torch.allclose(v, expected_v, atol=0.05))
+
+
+class MultiEmbeddingTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1234)
+        self.inputs = torch.LongTensor([[0, 1, 1, 0], [1, 1, 0, 0]])
+        self.tables = [torch.randn(2, 8) for _ in range(4)]
+        self.old_state_dict = {
+            'embeddings.{}.weight'.format(i): table
+            for i, table in enumerate(self.tables)
+        }
+        self.lookups = [
+            table[self.inputs[:, i]] for i, table in enumerate(self.tables)
+        ]
+
+    def testSum(self):
+        embed = karel_trace.MultiEmbedding([2] * 4, [8] * 4, 'sum')
+        self.assertEqual(
+            sorted(embed.state_dict()), sorted(self.old_state_dict))
+        embed.load_state_dict(self.old_state_dict)
+        self.assertTrue(
+            torch.allclose(embed(self.inputs), sum(self.lookups), atol=1e-6))
+
+    def testCat(self):
+        embed = karel_trace.MultiEmbedding([2] * 4, [8] * 4, 'cat')
+        embed.load_state_dict(self.old_state_dict)
+        self.assertTrue(
+            torch.equal(embed(self.inputs), torch.cat(self.lookups, dim=1)))
+
+    def testRestoreCheckpoint(self):
+        # Checkpoints from before the lookups were merged hold one
+        # nn.Embedding per column, along with their optimizer state.
+        old_embed = torch.nn.Module()
+        old_embed.embeddings = torch.nn.ModuleList(
+            [torch.nn.Embedding(2, 8) for _ in range(4)])
+        old_optimizer = torch.optim.Adam(old_embed.parameters())
+        sum(embedding(self.inputs[:, i]).sum()
+            for i, embedding in enumerate(old_embed.embeddings)).backward()
+        old_optimizer.step()
+
+        model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, model_dir)
+        saver.save_checkpoint(old_embed, old_optimizer, 1, model_dir)
+
+        embed = karel_trace.MultiEmbedding([2] * 4, [8] * 4, 'sum')
+        optimizer = torch.optim.Adam(embed.parameters())
+        self.assertEqual(
+            saver.load_checkpoint(embed, optimizer, model_dir), 1)
+        self.assertTrue(
+            torch.allclose(
+                embed(self.inputs),
+                sum(embedding(self.inputs[:, i])
+                    for i, embedding in enumerate(old_embed.embeddings)),
+                atol=1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()
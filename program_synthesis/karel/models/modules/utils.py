@@ -1,4 +1,5 @@
 import collections
+from typing import List, Tuple
 
 import torch
 from torch import nn
@@ -87,6 +88,93 @@ def lstm_init(cuda, num_layers, hidden_size, *batch_sizes):
     return (init, init)
 
 
+def _lstm_step(inputs, h, c, weights):
+    # type: (Tensor, Tensor, Tensor, List[Tensor]) -> Tuple[Tensor, Tensor, Tensor]
+    new_h = []
+    new_c = []
+    for layer in range(h.shape[0]):
+        w_ih = weights[4 * layer]
+        w_hh = weights[4 * layer + 1]
+        b_ih = weights[4 * layer + 2]
+        b_hh = weights[4 * layer + 3]
+        gates = (torch.addmm(b_ih, inputs, w_ih.t()) +
+                 torch.addmm(b_hh, h[layer], w_hh.t()))
+        in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+        layer_c = (torch.sigmoid(forget_gate) * c[layer] +
+                   torch.sigmoid(in_gate) * torch.tanh(cell_gate))
+        inputs = torch.sigmoid(out_gate) * torch.tanh(layer_c)
+        new_h.append(inputs)
+        new_c.append(layer_c)
+    return inputs, torch.stack(new_h), torch.stack(new_c)
+
+
+# torch.compile cannot trace into TorchScript, so compiled callers use the
+# plain Python version.
+_eager_lstm_step = _lstm_step
+if hasattr(torch.jit, 'script'):
+    _lstm_step = torch.jit.script(_lstm_step)
+
+
+def _is_compiling():
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and compiler.is_compiling()
+
+
+def lstm_weights(lstm):
+    '''Return the weights of nn.LSTM lstm as the flat list lstm_step uses.'''
+    return [w for layer in lstm.all_weights for w in layer]
+
+
+def lstm_step(lstm, inputs, state):
+    '''Run a single time step of a unidirectional nn.LSTM.
+
+    Equivalent to lstm(inputs.unsqueeze(0), state), but avoids the per-call
+    setup of nn.LSTM, which dominates when decoding one token at a time.
+
+    In training mode, lstm itself is called, so that training keeps using
+    nn.LSTM's (cuDNN) forward and backward.
+
+    inputs: batch x input size
+    state: tuple of h, c, each num layers x batch x hidden size
+    Returns output (batch x hidden size) and the new (h, c).
+    '''
+    if lstm.training:
+        time_dim = 1 if lstm.batch_first else 0
+        output, state = lstm(
+            inputs.unsqueeze(time_dim), tuple(v.contiguous() for v in state))
+        return output.squeeze(time_dim), state
+    return lstm_step_with_weights(lstm_weights(lstm), inputs, state)
+
+
+def lstm_step_with_weights(weights, inputs, state):
+    '''lstm_step, given lstm_weights(lstm) instead of the nn.LSTM.
+
+    torch.compile cannot trace code that touches nn.LSTM modules, so compiled
+    callers fetch the weights before entering the compiled region.
+    '''
+    step = _eager_lstm_step if _is_compiling() else _lstm_step
+    output, h, c = step(inputs, state[0], state[1], weights)
+    return output, (h, c)
+
+
+def quantize_dynamic(module):
+    '''Quantize the embeddings and linear layers of module to int8, in place.
+
+    LSTMs are left in floating point, as lstm_step reads their weights.
+    The quantized layers only run on the CPU.
+    '''
+    from torch.ao import quantization
+    weight_only = quantization.float_qparams_weight_only_qconfig
+    return quantization.quantize_dynamic(
+        module, {
+            nn.Linear: quantization.default_dynamic_qconfig,
+            nn.Embedding: weight_only,
+            nn.EmbeddingBag: weight_only,
+        },
+        dtype=torch.qint8,
+        inplace=True)
+
+
 class EncodedSequence(
         collections.namedtuple('EncodedSequence', ['mem', 'state'])):
 
@@ -120,14 +208,24 @@ class MaskedMemory(
 
 
 def get_attn_mask(seq_lengths, cuda):
-    max_length, batch_size = max(seq_lengths), len(seq_lengths)
-    ranges = torch.arange(
-        0, max_length,
-        out=torch.LongTensor()).unsqueeze(0).expand(batch_size, -1)
-    attn_mask = (ranges >= torch.LongTensor(seq_lengths).unsqueeze(1))
+    # Only the lengths are moved to the GPU; the mask is built there.
+    max_length = int(max(seq_lengths))
+    seq_lengths = torch.LongTensor(seq_lengths)
     if cuda:
-        attn_mask = attn_mask.cuda()
-    return attn_mask
+        seq_lengths = seq_lengths.cuda()
+    ranges = torch.arange(0, max_length, out=seq_lengths.new())
+    return ranges.unsqueeze(0) >= seq_lengths.unsqueeze(1)
+
+
+def beam_indices_to_flat(indices, batch_size, flat_size, device):
+    '''Convert beam search indices into indices along a dimension of size
+    flat_size = batch size * beam size.
+
+    indices: 2 x batch size * beam size LongTensor of (batch, beam) pairs
+    device: device of the tensor the result will index
+    '''
+    flat_indices = indices[0] * (flat_size // batch_size) + indices[1]
+    return flat_indices.to(device)
 
 
 class MultiContextLSTMState(
@@ -139,18 +237,16 @@ class MultiContextLSTMState(
         batch size: int
         indices: 2 x batch size * beam size LongTensor
         '''
+        flat_indices = beam_indices_to_flat(indices, batch_size,
+                                            self.h.shape[1], self.h.device)
         selected = [
-            None if self.context is None else self.context.view(
-                batch_size, -1,
-                *self.context.shape[1:])[indices.data.numpy()]
+            None if self.context is None else self.context.index_select(
+                0, flat_indices)
         ]
         for v in self.h, self.c:
             # before: 2 x batch size (* beam size) x num pairs x hidden
-            # after:  2 x batch size x beam size x num pairs x hidden
-            v = v.view(2, batch_size, -1, *v.shape[2:])
             # result: 2 x indices.shape[1] x num pairs x hidden
-            selected.append(v[(slice(None), ) + tuple(indices.data.numpy(
-            ))])
+            selected.append(v.index_select(1, flat_indices))
         return MultiContextLSTMState(*selected)
 
     def truncate(self, k):
@@ -0,0 +1,78 @@
+import unittest
+
+import torch
+
+from program_synthesis.karel.models.modules import utils
+
+
+class LSTMStepTest(unittest.TestCase):
+    def testMatchesLSTM(self):
+        torch.manual_seed(1234)
+        lstm = torch.nn.LSTM(
+            input_size=10, hidden_size=8, num_layers=2).eval()
+        inputs = torch.randn(5, 10)
+        state = (torch.randn(2, 5, 8), torch.randn(2, 5, 8))
+
+        expected_output, expected_state = lstm(inputs.unsqueeze(0), state)
+        output, new_state = utils.lstm_step(lstm, inputs, state)
+
+        self.assertTrue(torch.allclose(output, expected_output[0], atol=1e-6))
+        for v, expected_v in zip(new_state, expected_state):
+            self.assertTrue(torch.allclose(v, expected_v, atol=1e-6))
+
+    def testTrainingBatchFirst(self):
+        torch.manual_seed(1234)
+        lstm = torch.nn.LSTM(
+            input_size=10, hidden_size=8, num_layers=2, batch_first=True)
+        inputs = torch.randn(5, 10)
+        state = (torch.randn(2, 5, 8), torch.randn(2, 5, 8))
+
+        expected_output, expected_state = lstm(inputs.unsqueeze(1), state)
+        output, new_state = utils.lstm_step(lstm, inputs, state)
+
+        self.assertTrue(torch.equal(output, expected_output[:, 0]))
+        for v, expected_v in zip(new_state, expected_state):
+            self.assertTrue(torch.equal(v, expected_v))
+
+
+class GetAttnMaskTest(unittest.TestCase):
+    def testMasksPadding(self):
+        mask = utils.get_attn_mask([3, 1, 2], False)
+        self.assertEqual(mask.tolist(), [[False, False, False],
+                                         [False, True, True],
+                                         [False, False, True]])
+
+
+class BeamIndicesToFlatTest(unittest.TestCase):
+    def testFlattensOnDevice(self):
+        indices = torch.LongTensor([[0, 0, 1, 1], [1, 0, 2, 1]])
+        target = torch.zeros(6, device='meta')
+        flat_indices = utils.beam_indices_to_flat(
+            indices, 2, 6, target.device)
+        self.assertEqual(flat_indices.device, target.device)
+        self.assertEqual(
+            utils.beam_indices_to_flat(indices, 2, 6, 'cpu').tolist(),
+            [1, 0, 5, 4])
+
+
+class QuantizeDynamicTest(unittest.TestCase):
+    def testKeepsLSTM(self):
+        torch.manual_seed(1234)
+        module = torch.nn.ModuleList([
+            torch.nn.Embedding(5, 8),
+            torch.nn.LSTM(input_size=8, hidden_size=8, num_layers=2),
+            torch.nn.Linear(8, 5),
+        ])
+        inputs = torch.randn(3, 8)
+        expected = module[2](inputs)
+
+        utils.quantize_dynamic(module)
+
+        self.assertIsNot(type(module[0]), torch.nn.Embedding)
+        self.assertIs(type(module[1]), torch.nn.LSTM)
+        self.assertIsNot(type(module[2]), torch.nn.Linear)
+        self.assertTrue(torch.allclose(module[2](inputs), expected, atol=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
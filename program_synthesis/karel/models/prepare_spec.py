@@ -73,7 +73,7 @@ def batch_bounds_for_packing(lengths):
 
 
 PSPInterleaveInfo = collections.namedtuple('PSPInterleaveInfo',
-        ['input_indices', 'output_indices', 'psp_template'])
+        ['gather_indices', 'psp_template'])
 
 
 def prepare_interleave_packed_sequences(psps, interleave_indices):
@@ -89,9 +89,10 @@ def prepare_interleave_packed_sequences(psps, interleave_indices):
     # Precondition:- all PSPs have same type and item shape
     #
     # Output: a result computed by
-    # result[output_indices[i]] = psps[i].ps.data[input_indices[i]]
-    output_indices = [[] for _ in psps]
-    input_indices = [[] for _ in psps]
+    # result = torch.cat([psp.ps.data for psp in psps])[gather_indices]
+    gather_indices = []
+    # Where each PSP's data starts within the concatenation.
+    data_offsets = np.cumsum([0] + [sum(psp.lengths) for psp in psps[:-1]])
 
     # combined_lengths: length of each sequence, in original batch order.
     #combined_lengths = np.sum(
@@ -108,25 +109,21 @@ def prepare_interleave_packed_sequences(psps, interleave_indices):
     batch_bounds = batch_bounds_for_packing(sorted_lengths)
     interleave_iters = [iter(lst) for lst in interleave_indices]
 
-    # idx: current cursor into result
     # i: distance from begining of sequence
-    write_idx = 0
     read_idx = [[0] * len(psps) for _ in sorted_lengths]
     try:
         for i, bound in enumerate(batch_bounds):
             for  j, orig_batch_idx in enumerate(orig_to_sort[:bound]):
                 # Figure out which PSP we should get
                 psp_idx = next(interleave_iters[orig_batch_idx])
-                # Record that we should write the value from this PSP here
-                output_indices[psp_idx].append(write_idx)
                 current_idx = read_idx[orig_batch_idx][psp_idx]
                 # Figure out what current_idx corresponds to inside the PSP.
                 assert current_idx < psps[psp_idx].lengths[j]
-                input_indices[psp_idx].append(
-                        int(psps[psp_idx].raw_index(orig_batch_idx,
-                            current_idx)))
+                # Record where the next result row comes from in the
+                # concatenated data
+                gather_indices.append(int(data_offsets[psp_idx]) + int(
+                    psps[psp_idx].raw_index(orig_batch_idx, current_idx)))
                 read_idx[orig_batch_idx][psp_idx] += 1
-                write_idx += 1
     except StopIteration:
         raise Exception('interleave_indices[{}] ended early'.format(
             orig_batch_idx))
@@ -140,28 +137,20 @@ def prepare_interleave_packed_sequences(psps, interleave_indices):
             ended = True
         assert ended
 
-    input_indices = [torch.LongTensor(t) for t in input_indices]
-    output_indices = [torch.LongTensor(t) for t in output_indices]
-
-    return PSPInterleaveInfo(input_indices, output_indices,
+    return PSPInterleaveInfo(torch.LongTensor(gather_indices),
             PackedSequencePlus(
-                torch.nn.utils.rnn.PackedSequence(None, batch_bounds),
+                torch.nn.utils.rnn.PackedSequence(
+                    None, torch.LongTensor(batch_bounds)),
                 sorted_lengths,
                 sort_to_orig,
                 orig_to_sort))
 
 
 def execute_interleave_psps(psps, interleave_info):
-    result = Variable(psps[0].ps.data.data.new(
-        sum(psp.ps.data.shape[0] for psp in psps), *psps[0].ps.data.shape[1:]))
-
-    for out_idx, inp_idx, psp in zip(interleave_info.output_indices,
-            interleave_info.input_indices, psps):
-        if psp.ps.data.is_cuda:
-            inp_idx = inp_idx.cuda()
-            out_idx = out_idx.cuda()
-        # psp.ps.data is a torch.autograd.Variable (despite its name)
-        result[out_idx] = psp.ps.data[inp_idx]
+    # psp.ps.data is a torch.autograd.Variable (despite its name)
+    data = torch.cat([psp.ps.data for psp in psps], dim=0)
+    gather_indices = interleave_info.gather_indices
+    result = data.index_select(0, gather_indices.to(data.device))
 
     return interleave_info.psp_template.apply(lambda _: result)
 
@@ -1,5 +1,8 @@
 import unittest
 
+import numpy as np
+import torch
+
 from program_synthesis.karel.models import prepare_spec
 
 
@@ -35,5 +38,43 @@ class PackedSequenceTest(unittest.TestCase):
         self.assertEqual(psp_t.sort_to_orig, [3, 4, 5, 6, 7, 8, 0, 1, 2])
         self.assertEqual(psp_t.orig_to_sort, [6, 7, 8, 0, 1, 2, 3, 4, 5])
 
+class InterleaveTest(unittest.TestCase):
+
+    def test_matches_scatter(self):
+        rng = np.random.RandomState(1234)
+        lengths = [5, 3, 3, 1, 4]
+        table = torch.randn(100, 3, requires_grad=True)
+        grids, actions = [
+            prepare_spec.lists_to_packed_sequence(
+                [rng.randint(100, size=n).tolist() for n in lengths],
+                int, False, False).apply(lambda d: table[d] * scale)
+            for scale in (1, 2)]
+        interleave_indices = [[0] + [1, 0] * (n - 1) + [1] for n in lengths]
+
+        interleave = prepare_spec.prepare_interleave_packed_sequences(
+            (grids, actions), interleave_indices)
+        result = prepare_spec.execute_interleave_psps(
+            (grids, actions), interleave)
+
+        # What execute_interleave_psps used to compute with one scatter per
+        # PSP: result row by row, in the order given by interleave_indices.
+        expected = table.new_zeros(result.ps.data.shape)
+        for orig_batch_idx, psp_idxs in enumerate(interleave_indices):
+            read_idx = [0, 0]
+            for seq_idx, psp_idx in enumerate(psp_idxs):
+                expected[interleave.psp_template.raw_index(
+                    orig_batch_idx, seq_idx)] = (grids, actions)[
+                        psp_idx].select(orig_batch_idx, read_idx[psp_idx])
+                read_idx[psp_idx] += 1
+
+        self.assertTrue(torch.equal(result.ps.data, expected))
+        weights = torch.randn(expected.shape)
+        grad, = torch.autograd.grad(
+            (result.ps.data * weights).sum(), table, retain_graph=True)
+        expected_grad, = torch.autograd.grad(
+            (expected * weights).sum(), table)
+        self.assertTrue(torch.allclose(grad, expected_grad))
+
+
 if __name__ == '__main__':
     unittest.main()
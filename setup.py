@@ -37,6 +37,12 @@ setup(
         'tensorflow',
         'tqdm',
     ],
+    extras_require={
+        # Compiles karel_runtime.batched_step. numba>=0.60 needs numpy>=1.22,
+        # which conflicts with the numpy~=1.13.0 pin in requires.txt; without
+        # numba, batched_step falls back to plain NumPy.
+        'numba': ['numba>=0.60'],
+    },
     project_urls={
         'Source': "https://github.com/nearai/program_synthesis",
     },